@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import argparse
-from iotbotocredentialprovider.FakeMetadata import FakeMetadataServer, FakeMetadataRequestHandler, PORT
+from iotbotocredentialprovider.FakeMetadata import FakeMetadataServer, FakeMetadataRequestHandler, PORT, \
+    UNIX_SOCKET_PATH, UNIX_SOCKET_MODE
+from iotbotocredentialprovider.Debug import DEBUG_PORT
 
 # this will require that
 # the following be set:
@@ -13,8 +15,20 @@ if __name__ == "__main__":
                         help="port to listen on defaults to %s" % PORT, required=False, default=PORT)
     parser.add_argument("--host", dest="host", default="0.0.0.0",
                         help="host to bind to defaults to 0.0.0.0")
+    parser.add_argument("--unix-socket", dest="unix_socket", default=None,
+                        help="also listen on this unix domain socket, e.g. %s" % UNIX_SOCKET_PATH)
+    parser.add_argument("--unix-socket-mode", dest="unix_socket_mode", type=lambda mode: int(mode, 8),
+                        default=UNIX_SOCKET_MODE,
+                        help="octal permissions for the unix socket, defaults to %o" % UNIX_SOCKET_MODE)
+    parser.add_argument("--unix-socket-group", dest="unix_socket_group", default=None,
+                        help="group name or id to own the unix socket, e.g. one shared with consumers")
+    parser.add_argument("--debug-port", type=int, dest="debug_port", default=None,
+                        help="serve profiling and thread dump endpoints on 127.0.0.1 at this port, "
+                             "e.g. %s, disabled by default" % DEBUG_PORT)
     args = parser.parse_args()
 
-    print("got args host=%s port=%s" % (args.host, args.port))
-    f = FakeMetadataServer(FakeMetadataRequestHandler, host=args.host, port=args.port)
+    print("got args host=%s port=%s unix_socket=%s" % (args.host, args.port, args.unix_socket))
+    f = FakeMetadataServer(FakeMetadataRequestHandler, host=args.host, port=args.port,
+                           unix_socket_path=args.unix_socket, unix_socket_mode=args.unix_socket_mode,
+                           unix_socket_group=args.unix_socket_group, debug_port=args.debug_port)
     f.run()
@@ -4,7 +4,9 @@ import requests
 import json
 import os
 import logging
+import random
 import botocore.auth
+from threading import RLock, Timer
 from botocore.credentials import CredentialProvider, RefreshableCredentials
 
 
@@ -13,20 +15,47 @@ log.setLevel(logging.INFO)
 
 default_iot_metadata_path = os.environ.get("FAKE_METADATA_PATH", "/AWSIoT")
 
+# credentials are refreshed at 70% of their remaining lifetime plus up to 10%
+# (at least 30s, but never past expiration) of jitter
+REFRESH_FRACTION = 0.7
+REFRESH_JITTER_FRACTION = 0.1
+MINIMUM_REFRESH_JITTER = 30
+
 
 class IotBotoCredentialProviderError(Exception):
     pass
 
 
+class SystemClock(object):
+    """
+    Wall clock time and threading timers, tests and soak runs substitute a
+    virtual clock with the same interface
+    """
+
+    def utcnow(self):
+        return datetime.datetime.utcnow()
+
+    def timer(self, interval, function):
+        return Timer(interval, function)
+
+
 class IotBotoCredentialProvider(CredentialProvider):
-    def __init__(self, iot_metadata_path=default_iot_metadata_path):
+    def __init__(self, iot_metadata_path=default_iot_metadata_path, verify=True, clock=None, session=None):
         self.path = iot_metadata_path
+        # passed through to requests, a CA bundle path overrides the system trust store
+        self.verify = verify
+        self.clock = clock or SystemClock()
+        # optional requests.Session, e.g. with a stub transport adapter mounted
+        self.session = session
+        # one fetch at a time, callers finding expired credentials wait for it
+        # rather than all going to the endpoint
+        self._lock = RLock()
         self._metadata_file = os.path.join(self.path, "metadata.json")
 
     @property
     def metadata(self):
         if not hasattr(self, "_metadata") or \
-                os.stat(self._metadata_file) != self._metadata_mtime:
+                os.stat(self._metadata_file).st_mtime != self._metadata_mtime:
 
             self._populate_metadata()
         return self._metadata
@@ -36,19 +65,29 @@ class IotBotoCredentialProvider(CredentialProvider):
             self._metadata = json.load(f)
             self._metadata_mtime = os.stat(self._metadata_file).st_mtime
 
-    @property
-    def credentials(self):
-        now = datetime.datetime.utcnow()
+    def _have_fresh_credentials(self):
+        now = self.clock.utcnow()
 
-        if hasattr(self, "_credentials") and \
+        return hasattr(self, "_credentials") and \
             hasattr(self, "_credential_expiration") and \
-                self._credential_expiration > now:
+            self._credential_expiration > now
 
+    @property
+    def credentials(self):
+        if self._have_fresh_credentials():
             return self._credentials
 
-        return self.get_credentials()
+        with self._lock:
+            # another thread may have fetched while this one waited
+            if self._have_fresh_credentials():
+                return self._credentials
+            return self.get_credentials()
 
     def get_credentials(self):
+        with self._lock:
+            return self._get_credentials()
+
+    def _get_credentials(self):
         url = "%s/role-aliases/%s/credentials" % (self.metadata['credential_endpoint'],
                                                   self.metadata['role_alias_name'])
 
@@ -57,7 +96,7 @@ class IotBotoCredentialProvider(CredentialProvider):
         certificate_file = os.path.join(self.path, "%s.pem" % self.metadata['certificate_id'])
         private_key_file = os.path.join(self.path, "%s.privatekey" % self.metadata['certificate_id'])
 
-        o = requests.get(url, cert=(certificate_file, private_key_file), headers=headers)
+        o = (self.session or requests).get(url, cert=(certificate_file, private_key_file), headers=headers, verify=self.verify)
         response = json.loads(o.text)
 
         if o.status_code == 200:
@@ -68,6 +107,26 @@ class IotBotoCredentialProvider(CredentialProvider):
 
         raise IotBotoCredentialProviderError(response)
 
+    def get_refresh_seconds(self):
+        if not hasattr(self, "_credential_expiration"):
+            expire_time = datetime.datetime.strptime(self.credentials['expiration'],
+                                                     botocore.auth.ISO8601)
+            self._credential_expiration = expire_time
+
+        now = self.clock.utcnow()
+        # total_seconds, not seconds, which wraps for expired or day+ lifetimes
+        expiration = max(0, int((self._credential_expiration - now).total_seconds()))
+        log.debug("credentials expire in %s seconds", expiration)
+        refresh_jitter = int(REFRESH_JITTER_FRACTION * expiration)
+        if refresh_jitter < MINIMUM_REFRESH_JITTER:
+            refresh_jitter = MINIMUM_REFRESH_JITTER
+        # short lived credentials must still be refreshed before they expire
+        latest_jitter = (1 - REFRESH_FRACTION) * expiration
+        if expiration > 0 and refresh_jitter > latest_jitter:
+            refresh_jitter = max(1, int(latest_jitter))
+        refresh_time = REFRESH_FRACTION * expiration + random.randrange(0, refresh_jitter)
+        return refresh_time
+
     @property
     def boto3_credentials(self):
         return {
@@ -78,9 +137,10 @@ class IotBotoCredentialProvider(CredentialProvider):
         }
 
     def _refresh_credentials(self):
-        if hasattr(self, "_credentials"):
-            del self._credentials
-        return self.credentials
+        with self._lock:
+            if hasattr(self, "_credentials"):
+                del self._credentials
+            return self.credentials
 
     def _fetch_metadata(self):
         self._refresh_credentials()
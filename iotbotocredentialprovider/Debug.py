@@ -0,0 +1,237 @@
+import cProfile
+import logging
+import pstats
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from StringIO import StringIO
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from io import StringIO
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# The debug server is opt-in and only ever binds to loopback, it is kept off
+# the metadata port so containers redirected to the metadata server can't reach it.
+DEBUG_HOST = "127.0.0.1"
+DEBUG_PORT = 51681
+DEBUG_ALLOWED_SOURCES = ['127.0.0.1']
+PROFILE_PATH = "/debug/profile"
+TRACEMALLOC_PATH = "/debug/tracemalloc"
+THREADS_PATH = "/debug/threads"
+DEFAULT_DEBUG_WINDOW = 10
+MAX_DEBUG_WINDOW = 300
+DEFAULT_DEBUG_LIMIT = 30
+MAX_DEBUG_LIMIT = 1000
+MAX_TRACEMALLOC_FRAMES = 100
+
+# one tracemalloc window at a time, otherwise the first to finish stops
+# tracing while the other is still sampling
+_tracemalloc_lock = threading.Lock()
+
+
+class RequestProfiler(object):
+    """
+    Collects cProfile statistics for requests while a profiling window is open.
+
+    Outside of a window runcall() simply calls through. Inside a window each
+    request is profiled on its own cProfile.Profile and merged into the
+    window's statistics; requests are serialized while profiling since only
+    one profiler can be active at a time on newer interpreters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._window_lock = threading.Lock()
+        self._stats = None
+        self.requests = 0
+
+    @property
+    def active(self):
+        return self._stats is not None
+
+    def runcall(self, func, *args, **kwargs):
+        if not self.active:
+            return func(*args, **kwargs)
+
+        with self._lock:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                if self._stats is not None:
+                    self._stats.append(profile)
+                    self.requests += 1
+
+    def profile(self, seconds, sort="cumulative", limit=DEFAULT_DEBUG_LIMIT):
+        """
+        Profile requests for the next seconds, returns a pstats report
+        """
+        with self._window_lock:
+            with self._lock:
+                self._stats = []
+                self.requests = 0
+
+            time.sleep(seconds)
+
+            with self._lock:
+                profiles, self._stats = self._stats, None
+
+        output = StringIO()
+        output.write("profiled %d requests over %s seconds\n" % (len(profiles), seconds))
+        if profiles:
+            stats = pstats.Stats(profiles[0], stream=output)
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+
+def tracemalloc_diff(seconds, frames=1, limit=DEFAULT_DEBUG_LIMIT):
+    """
+    Snapshot allocations, wait seconds, snapshot again and report the biggest
+    differences along with the largest current allocations.
+    """
+    with _tracemalloc_lock:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(frames)
+
+        try:
+            before = tracemalloc.take_snapshot()
+            time.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if started:
+                tracemalloc.stop()
+
+    lines = ["traced memory current=%d peak=%d bytes" % (current, peak), "",
+             "top %d differences over %s seconds:" % (limit, seconds)]
+    lines.extend(str(stat) for stat in after.compare_to(before, "lineno")[:limit])
+    lines.extend(["", "top %d allocations:" % limit])
+    lines.extend(str(stat) for stat in after.statistics("lineno")[:limit])
+    return "\n".join(lines) + "\n"
+
+
+def dump_threads():
+    """
+    Return the stack of every thread, including the credential refresh timers
+    """
+    frames = sys._current_frames()
+    lines = []
+    for thread in threading.enumerate():
+        lines.append("Thread %s (ident=%s daemon=%s):" % (thread.name, thread.ident, thread.daemon))
+        frame = frames.get(thread.ident)
+        if frame is not None:
+            lines.extend(line.rstrip("\n") for line in traceback.format_stack(frame))
+        lines.append("")
+    return "\n".join(lines)
+
+
+class DebugRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the debug endpoints:
+
+    GET /debug/profile?seconds=10&sort=cumulative&limit=30
+        profile metadata requests for the window and return pstats output
+    GET /debug/tracemalloc?seconds=10&frames=1&limit=30
+        return allocation differences across the window
+    GET /debug/threads
+        return the stack of every thread
+
+    The server's profiler attribute must be the RequestProfiler used by the
+    metadata request handler.
+    """
+
+    def send_text(self, status, text):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self.client_address[0] in DEBUG_ALLOWED_SOURCES:
+            return self.send_text(403, "Forbidden\n")
+
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        params = parse_qs(url.query)
+
+        try:
+            seconds = min(max(float(params.get("seconds", [DEFAULT_DEBUG_WINDOW])[0]), 0), MAX_DEBUG_WINDOW)
+            limit = int(params.get("limit", [DEFAULT_DEBUG_LIMIT])[0])
+            frames = int(params.get("frames", [1])[0])
+        except ValueError as e:
+            return self.send_text(400, "%s\n" % e)
+
+        if not 1 <= limit <= MAX_DEBUG_LIMIT:
+            return self.send_text(400, "limit must be between 1 and %d\n" % MAX_DEBUG_LIMIT)
+        if not 1 <= frames <= MAX_TRACEMALLOC_FRAMES:
+            return self.send_text(400, "frames must be between 1 and %d\n" % MAX_TRACEMALLOC_FRAMES)
+
+        if path == PROFILE_PATH:
+            sort = params.get("sort", ["cumulative"])[0]
+            # reject before waiting out the window, which may see no requests to sort
+            if sort not in pstats.Stats.sort_arg_dict_default:
+                return self.send_text(400, "unknown sort key %s\n" % sort)
+            result = self.server.profiler.profile(seconds, sort=sort, limit=limit)
+        elif path == TRACEMALLOC_PATH:
+            result = tracemalloc_diff(seconds, frames=frames, limit=limit)
+        elif path == THREADS_PATH:
+            result = dump_threads()
+        else:
+            return self.send_text(404, "Not Found\n")
+
+        self.send_text(200, result)
+
+
+class ThreadingDebugHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeMetadataDebugServer(object):
+    """
+    Loopback only server exposing DebugRequestHandler
+
+    .. code-block:: shell
+
+        fakemetadata-server.py --debug-port 51681
+        curl "http://127.0.0.1:51681/debug/profile?seconds=30"
+
+    """
+
+    def __init__(self, profiler, host=DEBUG_HOST, port=DEBUG_PORT):
+        if host not in DEBUG_ALLOWED_SOURCES:
+            raise ValueError("debug server must bind to loopback, not %s" % host)
+        self.host = host
+        self.server = ThreadingDebugHTTPServer((host, port), DebugRequestHandler)
+        self.server.profiler = profiler
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        print("run debug server on %s:%s" % (self.host, self.port))
+        self._thread = threading.Thread(target=self.server.serve_forever, name="FakeMetadataDebugServer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server.server_close()
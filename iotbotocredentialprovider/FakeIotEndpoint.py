@@ -0,0 +1,298 @@
+import botocore.auth
+import datetime
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import ssl
+import subprocess
+import tempfile
+import time
+import uuid
+from threading import Lock, Thread
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# A local stand-in for the AWS IoT credentials provider endpoint, intended for
+# tests which want real mutual TLS, HTTP status handling and latency rather than
+# a mocked requests.get.  Certificates are issued with the openssl command line
+# tool so no additional python dependencies are needed.
+
+OPENSSL = os.environ.get("OPENSSL", "openssl")
+CREDENTIALS_PATH_RE = re.compile(r"^/role-aliases/(?P<role_alias>[^/]+)/credentials/?$")
+THING_NAME_HEADER = "x-amzn-iot-thingname"
+DEFAULT_TTL = 3600
+MALFORMED_BODY = '{"credentials": {"accessKeyId": '
+
+SERVER_EXTENSIONS = """basicConstraints=critical,CA:FALSE
+keyUsage=critical,digitalSignature,keyEncipherment
+extendedKeyUsage=serverAuth
+subjectKeyIdentifier=hash
+authorityKeyIdentifier=keyid,issuer
+subjectAltName=DNS:localhost,IP:127.0.0.1
+"""
+
+CLIENT_EXTENSIONS = """basicConstraints=critical,CA:FALSE
+keyUsage=critical,digitalSignature,keyEncipherment
+extendedKeyUsage=clientAuth
+subjectKeyIdentifier=hash
+authorityKeyIdentifier=keyid,issuer
+"""
+
+
+class FakeIotEndpointError(Exception):
+    pass
+
+
+def _openssl(*args):
+    try:
+        subprocess.check_output((OPENSSL,) + args, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise FakeIotEndpointError("openssl %s failed: %s" % (args[0], getattr(e, "output", e)))
+
+
+class FakeIotCertificateAuthority(object):
+    """
+    A throwaway certificate authority which signs the endpoint's server
+    certificate and device certificates, files are removed by cleanup()
+    """
+
+    def __init__(self, directory=None, days=2):
+        self.directory = directory or tempfile.mkdtemp(prefix="fakeiotca")
+        self.days = str(days)
+        self.ca_file = os.path.join(self.directory, "ca.pem")
+        self.ca_key_file = os.path.join(self.directory, "ca.key")
+
+        _openssl("req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+                 "-keyout", self.ca_key_file, "-out", self.ca_file, "-days", self.days,
+                 "-subj", "/CN=Fake AWS IoT CA",
+                 "-addext", "basicConstraints=critical,CA:TRUE",
+                 "-addext", "keyUsage=critical,keyCertSign,cRLSign",
+                 "-addext", "subjectKeyIdentifier=hash")
+
+        self.server_certificate_file, self.server_key_file = self.issue("server", "localhost",
+                                                                        SERVER_EXTENSIONS)
+
+    def issue(self, name, common_name, extensions, directory=None,
+              certificate_suffix=".pem", key_suffix=".key"):
+        directory = directory or self.directory
+        certificate_file = os.path.join(directory, name + certificate_suffix)
+        key_file = os.path.join(directory, name + key_suffix)
+        csr_file = os.path.join(self.directory, name + ".csr")
+        extensions_file = os.path.join(self.directory, name + ".ext")
+
+        with open(extensions_file, "w") as f:
+            f.write(extensions)
+
+        _openssl("req", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+                 "-keyout", key_file, "-out", csr_file, "-subj", "/CN=%s" % common_name)
+        _openssl("x509", "-req", "-in", csr_file, "-CA", self.ca_file, "-CAkey", self.ca_key_file,
+                 "-set_serial", str(uuid.uuid4().int >> 64), "-out", certificate_file,
+                 "-days", self.days, "-extfile", extensions_file)
+        return certificate_file, key_file
+
+    def issue_device_certificate(self, registration_dir, certificate_id):
+        """
+        Write <certificate_id>.pem and <certificate_id>.privatekey into registration_dir
+        the way iotdeviceprovisioner lays them out
+        """
+        return self.issue(certificate_id, certificate_id, CLIENT_EXTENSIONS, directory=registration_dir,
+                          key_suffix=".privatekey")
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class FakeIotCredentialsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Responds to GET /role-aliases/<alias>/credentials the way the AWS IoT
+    credentials provider does, with faults injected per the endpoint settings
+    """
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+    def send_body(self, status, body):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        endpoint = self.server.endpoint
+        endpoint.record_request(self)
+
+        if endpoint.latency:
+            time.sleep(endpoint.latency)
+
+        match = CREDENTIALS_PATH_RE.match(self.path)
+        if match is None:
+            return self.send_body(404, json.dumps({"message": "Not Found"}))
+
+        if match.group("role_alias") != endpoint.role_alias_name:
+            return self.send_body(404, json.dumps({"message": "Role alias does not exist"}))
+
+        if not self.headers.get(THING_NAME_HEADER):
+            return self.send_body(400, json.dumps({"message": "Missing thing name"}))
+
+        if endpoint.should_fail():
+            return self.send_body(endpoint.error_status, json.dumps({"message": endpoint.error_message}))
+
+        if endpoint.should_malform():
+            return self.send_body(200, MALFORMED_BODY)
+
+        self.send_body(200, json.dumps({"credentials": endpoint.make_credentials()}))
+
+
+class ThreadingHTTPSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # rejected handshakes (no or untrusted client certificate) are expected
+        # in tests, don't print a traceback for each one
+        log.debug("%s - request failed", client_address[0], exc_info=True)
+
+
+class FakeIotCredentialsEndpoint(object):
+    """
+    Local HTTPS server standing in for https://<prefix>.credentials.iot.<region>.amazonaws.com,
+    client certificates signed by its certificate authority are required.
+
+    .. code-block:: python
+
+        with FakeIotCredentialsEndpoint(ttl=900, latency=0.2, error_rate=0.1) as endpoint:
+            endpoint.register_device(registration_dir, device_name="test1")
+            cp = IotBotoCredentialProvider(registration_dir, verify=endpoint.ca_file)
+            cp.get_credentials()
+
+    :param str role_alias_name: the only role alias served, others get a 404
+    :param int ttl: lifetime in seconds of the credentials issued
+    :param float latency: seconds to sleep before answering each request
+    :param float error_rate: fraction of credential requests answered with error_status
+    :param float malformed_rate: fraction of credential requests answered with a truncated json body
+    :param int seed: seed for the fault injection random number generator
+    """
+
+    def __init__(self, role_alias_name="TestRole", ttl=DEFAULT_TTL, latency=0, error_rate=0,
+                 error_status=503, error_message="Service Unavailable", malformed_rate=0,
+                 host="127.0.0.1", port=0, seed=None, certificate_authority=None):
+        self.role_alias_name = role_alias_name
+        self.ttl = ttl
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.error_message = error_message
+        self.malformed_rate = malformed_rate
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.requests = []
+        self._lock = Lock()
+
+        self._owns_certificate_authority = certificate_authority is None
+        self.certificate_authority = certificate_authority or FakeIotCertificateAuthority()
+        self.server = None
+        self._thread = None
+
+    @property
+    def ca_file(self):
+        return self.certificate_authority.ca_file
+
+    @property
+    def url(self):
+        return "https://localhost:%d" % self.port
+
+    @property
+    def request_count(self):
+        return len(self.requests)
+
+    def record_request(self, handler):
+        with self._lock:
+            self.requests.append((handler.path, handler.headers.get(THING_NAME_HEADER)))
+
+    def should_fail(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def should_malform(self):
+        with self._lock:
+            return self.random.random() < self.malformed_rate
+
+    def make_credentials(self):
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl)
+        return {
+            "accessKeyId": "ASIA" + uuid.uuid4().hex[:16].upper(),
+            "secretAccessKey": uuid.uuid4().hex + uuid.uuid4().hex[:8],
+            "sessionToken": uuid.uuid4().hex * 4,
+            "expiration": expiration.strftime(botocore.auth.ISO8601),
+        }
+
+    def register_device(self, registration_dir, device_name="test1", certificate_id=None,
+                        account_id="0123456789", region="us-test-1"):
+        """
+        Populate registration_dir with metadata.json and a device certificate
+        pointing at this endpoint, which must already be started
+        """
+        if self.server is None:
+            raise FakeIotEndpointError("start the endpoint before registering devices, its port is not known yet")
+        certificate_id = certificate_id or uuid.uuid4().hex
+        self.certificate_authority.issue_device_certificate(registration_dir, certificate_id)
+
+        metadata = {
+            'account_id': account_id,
+            'certificate_id': certificate_id,
+            'credential_endpoint': self.url,
+            'device_name': device_name,
+            'region': region,
+            'role_alias_name': self.role_alias_name,
+        }
+        with open(os.path.join(registration_dir, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+        return metadata
+
+    def start(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.certificate_authority.server_certificate_file,
+                                self.certificate_authority.server_key_file)
+        context.load_verify_locations(self.ca_file)
+        context.verify_mode = ssl.CERT_REQUIRED
+
+        self.server = ThreadingHTTPSServer((self.host, self.port), FakeIotCredentialsRequestHandler)
+        self.server.endpoint = self
+        # handshakes happen on the request threads rather than in accept()
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True,
+                                                 do_handshake_on_connect=False)
+        self.port = self.server.server_address[1]
+
+        self._thread = Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self._thread.join()
+            self.server = None
+        if self._owns_certificate_authority:
+            self.certificate_authority.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -1,18 +1,27 @@
-import botocore.auth
 import platform
 import datetime
+import grp
 import json
 import logging
 import os
-import random
+import socket
+import stat
 import sys
-from threading import Timer
-from .AWS import IotBotoCredentialProvider, default_iot_metadata_path
+from threading import Condition, Thread
+from botocore.credentials import CredentialProvider, RefreshableCredentials
+from .AWS import IotBotoCredentialProvider, IotBotoCredentialProviderError, default_iot_metadata_path
+from .Debug import FakeMetadataDebugServer, RequestProfiler
 
 try:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from httplib import HTTPConnection
+    from urlparse import urlparse, parse_qs
 except ImportError:
     from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse, parse_qs
 
 
 log = logging.getLogger()
@@ -34,10 +43,23 @@ SIGNATURE_PATH = "/latest/dynamic/instance-identity/signature"
 PLACEMENT_AVAILABILITY_ZONE_PATH = "/latest/meta-data/placement/availability-zone"
 PING_PATH = "/ping"
 PING_RESPONSE = "pong"
+# long-poll endpoint announcing credential rotations, clients pass the last
+# sequence they saw as ?since=N and block until a newer rotation or ?timeout=S
+ROTATION_PATH = "/rotation"
+DEFAULT_ROTATION_WAIT = 60
+MAX_ROTATION_WAIT = 300
 INSTANCE_DOCUMENT_OVERRIDE_FILE = os.path.join(default_iot_metadata_path, "instance_document_overrides.json")
 
 ALLOWED_SOURCES = ['169.254.170.2', '169.254.169.254']
 
+# same-host consumers (e.g. containers with the socket mounted) can skip the
+# iptables DNAT and talk to the server over a unix domain socket instead,
+# access is then controlled by the socket's file permissions
+UNIX_SOCKET_PATH = os.environ.get("FAKE_METADATA_SOCKET", "/var/run/fakemetadata/metadata.sock")
+# owner and group only, socket clients are not checked against ALLOWED_SOURCES
+UNIX_SOCKET_MODE = 0o660
+UNIX_SOCKET_CLIENT = "unix"
+
 
 def json_serial(obj):
     """
@@ -51,6 +73,11 @@ def json_serial(obj):
 
 
 class FakeMetadataCredentialProvider(IotBotoCredentialProvider):
+    def __init__(self, *args, **kwargs):
+        super(FakeMetadataCredentialProvider, self).__init__(*args, **kwargs)
+        self._rotation_sequence = 0
+        self._rotation_condition = Condition()
+
     @property
     def role_name(self):
         return self.metadata['role_alias_name']
@@ -76,35 +103,63 @@ class FakeMetadataCredentialProvider(IotBotoCredentialProvider):
         return self.metadata["region"]
 
     def update_timer(self, refresh_time_seconds=300):
-        self._update_timer = Timer(refresh_time_seconds, self.get_credentials)
-        self._update_timer.daemon = True
-        logging.info("will refresh creds in %s", refresh_time_seconds)
-        self._update_timer.start()
+        timer = self.clock.timer(refresh_time_seconds, self.get_credentials)
+        timer.name = "FakeMetadataRefreshTimer"
+        timer.daemon = True
+        with self._lock:
+            # credentials fetched on demand reschedule the refresh, don't leave
+            # the previous timer running alongside the new one
+            self.cancel_timer()
+            self._update_timer = timer
+            logging.info("will refresh creds in %s", refresh_time_seconds)
+            timer.start()
 
     def cancel_timer(self):
         if hasattr(self, "_update_timer"):
             self._update_timer.cancel()
 
-    def get_refresh_seconds(self):
-        if not hasattr(self, "_credential_expiration"):
-            expire_time = datetime.datetime.strptime(self.credentials['expiration'],
-                                                     botocore.auth.ISO8601)
-            self._credential_expiration = expire_time
-
-        now = datetime.datetime.utcnow()
-        expiration = (self._credential_expiration - now).seconds
-        logging.debug("credentials expire in %s seconds", expiration)
-        refresh_jitter = int(0.1 * expiration)
-        if refresh_jitter < 30:
-            refresh_jitter = 30
-        refresh_time = 0.7 * expiration + random.randrange(0, refresh_jitter)
-        return refresh_time
+    @property
+    def rotation_sequence(self):
+        return self._rotation_sequence
+
+    def wait_for_rotation(self, since, timeout=DEFAULT_ROTATION_WAIT):
+        """
+        :param int since: the last rotation sequence the caller has seen
+        :param float timeout: maximum seconds to wait for a newer rotation
+
+        Block until credentials other than rotation since are available, returns
+        the current sequence, which equals since if the wait timed out.  A since
+        ahead of the current sequence (e.g. a client which kept its counter across
+        a server restart) is stale and returns immediately.
+        """
+        with self._rotation_condition:
+            if self._rotation_sequence in (0, since):
+                self._rotation_condition.wait(timeout)
+            return self._rotation_sequence
+
+    def rotation_event(self, since=None, timeout=DEFAULT_ROTATION_WAIT):
+        if since is None:
+            sequence = self._rotation_sequence
+        else:
+            sequence = self.wait_for_rotation(since, timeout)
 
-    def get_credentials(self):
-        result = super(FakeMetadataCredentialProvider, self).get_credentials()
-        self.update_timer(self.get_refresh_seconds())
+        # nothing to announce until credentials have been fetched
+        result = {"Sequence": sequence, "Rotated": sequence > 0 and sequence != since}
+        if sequence > 0:
+            result.update(self.metadata_credentials)
         return result
 
+    def get_credentials(self):
+        # request threads, the refresh timer and on-demand callers all get
+        # here, each fetch is followed by its own reschedule and announcement
+        with self._lock:
+            result = super(FakeMetadataCredentialProvider, self).get_credentials()
+            self.update_timer(self.get_refresh_seconds())
+            with self._rotation_condition:
+                self._rotation_sequence += 1
+                self._rotation_condition.notify_all()
+            return result
+
 
 class FakeMetadataRequestHandler(BaseHTTPRequestHandler):
     """
@@ -123,6 +178,8 @@ class FakeMetadataRequestHandler(BaseHTTPRequestHandler):
     # we want to use the same provider across all class instances
     # to allow for caching
     credential_provider = FakeMetadataCredentialProvider()
+    # shared with the debug server, which opens profiling windows on it
+    profiler = RequestProfiler()
 
     def get_credentials(self, RoleArn=None):
         return FakeMetadataRequestHandler.credential_provider.metadata_credentials
@@ -160,11 +217,32 @@ class FakeMetadataRequestHandler(BaseHTTPRequestHandler):
 
         return result
 
+    def get_rotation_event(self, query):
+        params = parse_qs(query)
+        since = None
+        timeout = DEFAULT_ROTATION_WAIT
+        try:
+            if "since" in params:
+                since = int(params["since"][0])
+            if "timeout" in params:
+                timeout = min(max(float(params["timeout"][0]), 0), MAX_ROTATION_WAIT)
+        except ValueError:
+            pass
+
+        return FakeMetadataRequestHandler.credential_provider.rotation_event(since, timeout)
+
     def do_PUT(self):
         return
 
     def do_GET(self):
-        if not self.client_address[0] in ALLOWED_SOURCES:
+        # rotation long-polls block for up to MAX_ROTATION_WAIT, profiling them
+        # would queue every other request behind the wait
+        if urlparse(self.path).path.rstrip("/") == ROTATION_PATH:
+            return self.handle_get()
+        return FakeMetadataRequestHandler.profiler.runcall(self.handle_get)
+
+    def handle_get(self):
+        if not self.client_address[0] in ALLOWED_SOURCES + [UNIX_SOCKET_CLIENT]:
             return
 
         our_role = self.get_role()
@@ -178,6 +256,7 @@ class FakeMetadataRequestHandler(BaseHTTPRequestHandler):
            (response_prefix, self.version_string(), self.date_time_string())
         result = ""
 
+        url = urlparse(self.path)
         stripped_path = self.path.rstrip("/")
         if stripped_path == PING_PATH:
             result = PING_RESPONSE
@@ -192,6 +271,8 @@ class FakeMetadataRequestHandler(BaseHTTPRequestHandler):
             result = self.get_identity_doc().get("instanceId")
         elif stripped_path == SIGNATURE_PATH:
             result = "bad"
+        elif url.path.rstrip("/") == ROTATION_PATH:
+            result = json.dumps(self.get_rotation_event(url.query), default=json_serial, indent=4)
         elif stripped_path != our_path:
             # client asked for a role we don't serve
             return_code = 404
@@ -220,6 +301,20 @@ class FakeMetadataRequestHandler(BaseHTTPRequestHandler):
         self.wfile.write(bytes(start_doc.encode("utf-8") + result.encode("utf-8")))
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # rotation long-polls hold a request open, so each request gets its own thread
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # unix sockets have no peer address, give the handler one it can check
+        request, _ = self.socket.accept()
+        return request, (UNIX_SOCKET_CLIENT, 0)
+
+
 class FakeMetadataServer(object):
     """
     This creates a server which acts like METADATA
@@ -233,9 +328,16 @@ class FakeMetadataServer(object):
 
     /sbin/iptables -t nat -A PREROUTING -p tcp -d 169.254.170.2   --dport 80 -j DNAT --to-destination 127.0.0.1:51679
 
+    Sidecars which want to learn about new credentials without polling can
+    long-poll ROTATION_PATH, e.g. GET /rotation?since=3&timeout=60 returns as
+    soon as rotation 4 is available, along with its credentials and expiration.
+    Clients should follow the returned Sequence; after a server restart it may
+    go backwards, and a since ahead of it returns the current credentials at once.
+
     """
 
-    def __init__(self, request_handler, host=None, port=None):
+    def __init__(self, request_handler, host=None, port=None, unix_socket_path=None,
+                 unix_socket_mode=UNIX_SOCKET_MODE, unix_socket_group=None, debug_port=None):
         self.request_handler = request_handler
         if host is None:
             self.host = HOST
@@ -247,16 +349,169 @@ class FakeMetadataServer(object):
             self.port = PORT
 
         print(" server for %s:%s" % (self.host, self.port))
-        self.server = HTTPServer((self.host, self.port), self.request_handler)
+        self.server = ThreadingHTTPServer((self.host, self.port), self.request_handler)
+
+        self.unix_socket_path = unix_socket_path
+        self.unix_server = None
+        if self.unix_socket_path is not None:
+            print(" server for unix:%s" % self.unix_socket_path)
+            self._remove_unix_socket()
+            self.unix_server = ThreadingUnixHTTPServer(self.unix_socket_path, self.request_handler,
+                                                       bind_and_activate=False)
+            # connections are refused until listen(), so set ownership and mode
+            # in between rather than touching the process wide umask
+            try:
+                self.unix_server.server_bind()
+                if unix_socket_group is not None:
+                    os.chown(self.unix_socket_path, -1, self._group_id(unix_socket_group))
+                os.chmod(self.unix_socket_path, unix_socket_mode)
+                self.unix_server.server_activate()
+            except Exception:
+                self.unix_server.server_close()
+                self.server.server_close()
+                self._remove_unix_socket()
+                raise
+
+        # profiling/thread dump endpoints, off unless a debug port is given
+        self.debug_server = None
+        if debug_port is not None:
+            self.debug_server = FakeMetadataDebugServer(self.request_handler.profiler, port=debug_port)
+
+    @staticmethod
+    def _group_id(group):
+        try:
+            return int(group)
+        except ValueError:
+            return grp.getgrnam(group).gr_gid
+
+    def _remove_unix_socket(self):
+        # only ever remove a stale socket, never a file that happens to be at the path
+        try:
+            mode = os.lstat(self.unix_socket_path).st_mode
+        except OSError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise ValueError("%s exists and is not a socket" % self.unix_socket_path)
+        os.unlink(self.unix_socket_path)
+
+    def _close_unix_server(self):
+        if self.unix_server is None:
+            return
+        self.unix_server.shutdown()
+        self.unix_server.server_close()
+        self.unix_server = None
+        self._remove_unix_socket()
+
+    def _close_debug_server(self):
+        if self.debug_server is not None:
+            self.debug_server.stop()
 
     def stop(self):
         self.request_handler.credential_provider.cancel_timer()
+        self._close_debug_server()
+        self._close_unix_server()
         self.server.shutdown()
         self.server.server_close()
 
     def run(self):
+        if self.debug_server is not None:
+            self.debug_server.start()
+
+        if self.unix_server is not None:
+            print("run server on unix:%s" % self.unix_socket_path)
+            unix_thread = Thread(target=self.unix_server.serve_forever)
+            unix_thread.daemon = True
+            unix_thread.start()
+
         print("run server on %s:%s" % (self.host, self.port))
         self.server.serve_forever()
         self.request_handler.credential_provider.cancel_timer()
+        self._close_debug_server()
+        self._close_unix_server()
         self.server.shutdown()
         self.server.server_close()
+
+
+class UnixSocketHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class FakeMetadataSocketClient(object):
+    """
+    Read from a FakeMetadataServer over its unix domain socket
+
+    .. code-block:: python
+
+        client = FakeMetadataSocketClient("/var/run/fakemetadata/metadata.sock")
+        credentials = client.get_credentials()
+
+    """
+
+    def __init__(self, socket_path=UNIX_SOCKET_PATH, timeout=5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def get(self, path, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        connection = UnixSocketHTTPConnection(self.socket_path, timeout=timeout)
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            body = response.read().decode("utf-8")
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            raise IotBotoCredentialProviderError("%s returned %s" % (path, response.status))
+        return body
+
+    def get_role(self):
+        return self.get(ROLE_PATH).strip()
+
+    def get_credentials(self):
+        return json.loads(self.get(ROLE_PATH + "/" + self.get_role()))
+
+    def wait_for_rotation(self, since, timeout=DEFAULT_ROTATION_WAIT):
+        path = "%s?since=%d&timeout=%s" % (ROTATION_PATH, since, timeout)
+        return json.loads(self.get(path, timeout=timeout + self.timeout))
+
+
+class FakeMetadataSocketCredentialProvider(CredentialProvider):
+    """
+    botocore credential provider reading from a FakeMetadataServer unix domain socket
+    """
+    METHOD = "fake-metadata-socket"
+
+    def __init__(self, socket_path=UNIX_SOCKET_PATH, timeout=5):
+        self.client = FakeMetadataSocketClient(socket_path, timeout=timeout)
+
+    def _fetch_metadata(self):
+        credentials = self.client.get_credentials()
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['Token'],
+            'expiry_time': credentials['Expiration']
+        }
+
+    def load(self):
+        fetcher = self._fetch_metadata
+
+        metadata = fetcher()
+        if not metadata:
+            return None
+
+        return RefreshableCredentials.create_from_metadata(
+            metadata,
+            method=self.METHOD,
+            refresh_using=fetcher,
+        )
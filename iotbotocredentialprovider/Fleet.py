@@ -0,0 +1,291 @@
+import boto3
+import botocore.session
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.credentials import CredentialProvider, RefreshableCredentials
+from .AWS import IotBotoCredentialProvider, IotBotoCredentialProviderError, default_iot_metadata_path
+
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+DEFAULT_MAX_WORKERS = 16
+# initial refreshes are spread uniformly over this many seconds so a gateway
+# starting up with thousands of certificates doesn't hit the IoT endpoint at once
+DEFAULT_STAGGER_SECONDS = 60
+# how long to wait before retrying a thing whose refresh failed
+DEFAULT_RETRY_SECONDS = 30
+
+
+class IotCredentialFleetError(Exception):
+    pass
+
+
+class IotCredentialFleetProvider(CredentialProvider):
+    """
+    botocore credential provider handing out the credentials a fleet keeps
+    fresh for one thing, so sessions don't fetch on their own schedule
+    """
+    METHOD = "iot-fleet"
+
+    def __init__(self, fleet, thing_name):
+        self.fleet = fleet
+        self.thing_name = thing_name
+
+    def _fetch_metadata(self):
+        # only fetches if the fleet's credentials are missing or expired
+        credentials = self.fleet.get_credentials(self.thing_name)
+        return {
+            'access_key': credentials['accessKeyId'],
+            'secret_key': credentials['secretAccessKey'],
+            'token': credentials['sessionToken'],
+            'expiry_time': credentials['expiration']
+        }
+
+    def load(self):
+        fetcher = self._fetch_metadata
+
+        return RefreshableCredentials.create_from_metadata(
+            fetcher(),
+            method=self.METHOD,
+            refresh_using=fetcher,
+        )
+
+
+class IotCredentialFleet(object):
+    """
+    Manage credentials for many AWS IoT registration directories on one host.
+
+    Gateways acting on behalf of downstream things hold one registration
+    directory (metadata.json, certificate and private key) per thing, e.g.
+
+        /AWSIoT/thing1/metadata.json
+        /AWSIoT/thing2/metadata.json
+
+    The fleet discovers these directories, keeps one IotBotoCredentialProvider
+    per thing name, and refreshes credentials before they expire from a single
+    scheduler thread feeding a bounded worker pool, so the number of threads
+    does not grow with the number of identities. Refresh times are jittered
+    so that things issued at the same time do not all renew at the same time.
+
+    .. code-block:: python
+
+        fleet = IotCredentialFleet("/AWSIoT")
+        fleet.discover()
+        fleet.start()
+
+        session = fleet.get_boto3_session("thing1", region_name="us-east-1")
+
+    """
+
+    def __init__(self, root_path=default_iot_metadata_path, max_workers=DEFAULT_MAX_WORKERS,
+                 stagger_seconds=DEFAULT_STAGGER_SECONDS, retry_seconds=DEFAULT_RETRY_SECONDS,
+                 provider_class=IotBotoCredentialProvider):
+        self.root_path = root_path
+        self.max_workers = max_workers
+        self.stagger_seconds = stagger_seconds
+        self.retry_seconds = retry_seconds
+        self.provider_class = provider_class
+
+        self._providers = {}
+        # heap of (refresh time, thing name); entries which no longer match
+        # _next_refresh are stale and skipped by the scheduler
+        self._schedule = []
+        self._next_refresh = {}
+        self._condition = threading.Condition()
+        self._executor = None
+        self._scheduler = None
+        self._stopped = True
+
+    @property
+    def thing_names(self):
+        with self._condition:
+            return sorted(self._providers.keys())
+
+    def __len__(self):
+        return len(self._providers)
+
+    def __contains__(self, thing_name):
+        return thing_name in self._providers
+
+    def _registration_paths(self):
+        if os.path.exists(os.path.join(self.root_path, "metadata.json")):
+            yield self.root_path
+
+        for entry in sorted(os.listdir(self.root_path)):
+            path = os.path.join(self.root_path, entry)
+            if os.path.isdir(path) and os.path.exists(os.path.join(path, "metadata.json")):
+                yield path
+
+    def add_path(self, iot_metadata_path):
+        """
+        :param str iot_metadata_path: registration directory containing metadata.json,
+            the certificate, and its private key
+
+        Add a single registration directory to the fleet, returns the thing name it serves.
+        """
+        provider = self.provider_class(iot_metadata_path)
+        thing_name = provider.metadata['device_name']
+
+        with self._condition:
+            existing = self._providers.get(thing_name)
+            if existing is not None and existing.path != provider.path:
+                raise IotCredentialFleetError("thing %s registered at both %s and %s" %
+                                              (thing_name, existing.path, provider.path))
+            if existing is None:
+                self._providers[thing_name] = provider
+                if not self._stopped:
+                    self._schedule_refresh(thing_name, random.uniform(0, self.stagger_seconds))
+
+        return thing_name
+
+    def remove(self, thing_name):
+        with self._condition:
+            self._providers.pop(thing_name, None)
+            self._next_refresh.pop(thing_name, None)
+
+    def discover(self):
+        """
+        Scan root_path for registration directories, adding new things and
+        dropping things whose directory has gone away.
+
+        Returns the sorted list of thing names now in the fleet.
+        """
+        seen = set()
+        for path in self._registration_paths():
+            try:
+                seen.add(self.add_path(path))
+            except (IOError, OSError, ValueError, KeyError) as e:
+                log.warning("skipping registration directory %s: %s", path, e)
+
+        for thing_name in set(self._providers.keys()) - seen:
+            log.info("thing %s no longer present under %s", thing_name, self.root_path)
+            self.remove(thing_name)
+
+        return self.thing_names
+
+    def get_provider(self, thing_name):
+        try:
+            return self._providers[thing_name]
+        except KeyError:
+            raise IotCredentialFleetError("unknown thing %s" % thing_name)
+
+    def get_credentials(self, thing_name):
+        return self.get_provider(thing_name).credentials
+
+    def get_botocore_session(self, thing_name, insert_before='iam-role'):
+        # raises for unknown things now rather than when credentials are first needed
+        self.get_provider(thing_name)
+        session = botocore.session.Session()
+        session.get_component('credential_provider').insert_before(
+            insert_before, IotCredentialFleetProvider(self, thing_name))
+        return session
+
+    def get_boto3_session(self, thing_name, region_name=None, insert_before='iam-role'):
+        provider = self.get_provider(thing_name)
+        if region_name is None:
+            region_name = provider.metadata['region']
+        return boto3.session.Session(
+            botocore_session=self.get_botocore_session(thing_name, insert_before=insert_before),
+            region_name=region_name
+        )
+
+    def get_refresh_seconds(self, thing_name):
+        return self.get_provider(thing_name).get_refresh_seconds()
+
+    def _schedule_refresh(self, thing_name, delay):
+        # caller holds self._condition
+        when = time.time() + delay
+        self._next_refresh[thing_name] = when
+        heapq.heappush(self._schedule, (when, thing_name))
+        self._condition.notify()
+
+    def refresh(self, thing_name):
+        """
+        Fetch new credentials for thing_name now and schedule the next refresh.
+        """
+        provider = self.get_provider(thing_name)
+        try:
+            # replaces the cached credentials in one step, readers never see them missing
+            provider.get_credentials()
+            # the provider in hand, thing_name may have been removed meanwhile
+            delay = provider.get_refresh_seconds()
+        except (IotBotoCredentialProviderError, IOError, ValueError, KeyError) as e:
+            log.warning("failed to refresh credentials for %s: %s", thing_name, e)
+            delay = self.retry_seconds + random.uniform(0, self.retry_seconds)
+
+        with self._condition:
+            if thing_name in self._providers and not self._stopped:
+                log.debug("will refresh %s in %s", thing_name, delay)
+                self._schedule_refresh(thing_name, delay)
+        return provider
+
+    def refresh_all(self):
+        """
+        Refresh every thing through the worker pool, waiting for all of them to complete.
+        """
+        if self._executor is not None:
+            futures = [self._executor.submit(self.refresh, thing_name) for thing_name in self.thing_names]
+            for future in futures:
+                future.result()
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(self.refresh, self.thing_names))
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                if not self._schedule:
+                    self._condition.wait()
+                    continue
+
+                when, thing_name = self._schedule[0]
+                if self._next_refresh.get(thing_name) != when:
+                    heapq.heappop(self._schedule)
+                    continue
+
+                delay = when - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                heapq.heappop(self._schedule)
+                del self._next_refresh[thing_name]
+                self._executor.submit(self.refresh, thing_name)
+
+    def start(self):
+        """
+        Start the scheduler thread and worker pool, every known thing gets its
+        first refresh at a random point within stagger_seconds.
+        """
+        with self._condition:
+            if not self._stopped:
+                return
+            self._stopped = False
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            for thing_name in self._providers:
+                self._schedule_refresh(thing_name, random.uniform(0, self.stagger_seconds))
+
+        self._scheduler = threading.Thread(target=self._run, name="IotCredentialFleet")
+        self._scheduler.daemon = True
+        self._scheduler.start()
+
+    def stop(self):
+        with self._condition:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._schedule = []
+            self._next_refresh = {}
+            self._condition.notify_all()
+
+        self._scheduler.join()
+        self._executor.shutdown(wait=True)
+        self._scheduler = None
+        self._executor = None
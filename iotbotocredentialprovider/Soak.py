@@ -0,0 +1,459 @@
+import argparse
+import array
+import botocore.auth
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import requests
+import requests.adapters
+from .AWS import MINIMUM_REFRESH_JITTER, REFRESH_FRACTION, REFRESH_JITTER_FRACTION, SystemClock
+from .FakeMetadata import FakeMetadataCredentialProvider
+
+
+log = logging.getLogger()
+
+# Soak testing of credential refresh scheduling: a virtual clock stands in for
+# datetime.utcnow() and threading.Timer so that days of credential rotations
+# against a stub endpoint run in seconds, while memory and refresh timing are
+# checked along the way.  A second, short phase runs real Timer threads on the
+# system clock with credentials lasting a couple of seconds to check the
+# number of threads stays bounded.
+
+SOAK_START_TIME = datetime.datetime(2020, 1, 1)
+SOAK_ENDPOINT = "https://soak.credentials.iot.us-test-1.amazonaws.com"
+DEFAULT_TTL = 3600
+DEFAULT_ROTATIONS = 5000
+MAX_PENDING_TIMERS = 1
+DEFAULT_THREAD_ROTATIONS = 10
+# expirations are whole seconds, 2s credentials are refreshed every ~0.7s
+THREAD_TTL = 2
+THREAD_POLL_INTERVAL = 0.01
+# the pending refresh timer, plus a timer still finishing the refresh which
+# scheduled it, plus one cancelled by an on-demand fetch which hasn't exited yet
+MAX_THREAD_GROWTH = 3
+# interpreter and library caches warming up, then a few bytes per rotation at most,
+# a provider keeping anything per refresh (timers, responses) exceeds this
+MEMORY_GROWTH_ALLOWANCE = 64 * 1024
+MAX_MEMORY_GROWTH_PER_ROTATION = 16
+REPORT_PERCENTILES = (0, 1, 5, 25, 50, 75, 95, 99, 100)
+HISTOGRAM_BUCKETS = 10
+
+
+class SoakError(Exception):
+    pass
+
+
+class VirtualTimer(object):
+    """
+    threading.Timer lookalike which fires when a VirtualClock is advanced past it
+    """
+
+    def __init__(self, clock, interval, function):
+        self.clock = clock
+        self.interval = interval
+        self.function = function
+        self.name = "VirtualTimer"
+        self.daemon = True
+        self.when = None
+        self._alive = False
+
+    def start(self):
+        self.when = self.clock.utcnow() + datetime.timedelta(seconds=self.interval)
+        self._alive = True
+        self.clock.schedule(self)
+
+    def cancel(self):
+        self._alive = False
+
+    def is_alive(self):
+        return self._alive
+
+    def fire(self):
+        self._alive = False
+        self.function()
+
+
+class VirtualClock(object):
+    """
+    Clock for IotBotoCredentialProvider whose time only moves when advanced,
+    timers fire in order as time passes them
+    """
+
+    def __init__(self, start=SOAK_START_TIME):
+        self.now = start
+        self._timers = []
+        self._counter = itertools.count()
+
+    def utcnow(self):
+        return self.now
+
+    def timer(self, interval, function):
+        return VirtualTimer(self, interval, function)
+
+    def schedule(self, timer):
+        heapq.heappush(self._timers, (timer.when, next(self._counter), timer))
+
+    @property
+    def pending_timers(self):
+        return len([timer for _, _, timer in self._timers if timer.is_alive()])
+
+    def next_timer(self):
+        while self._timers:
+            _, _, timer = self._timers[0]
+            if timer.is_alive():
+                return timer
+            heapq.heappop(self._timers)
+        return None
+
+    def step(self):
+        """
+        Move time forward to the next live timer and fire it, returns False when none are left
+        """
+        timer = self.next_timer()
+        if timer is None:
+            return False
+        heapq.heappop(self._timers)
+        self.now = max(self.now, timer.when)
+        timer.fire()
+        return True
+
+    def advance(self, seconds):
+        until = self.now + datetime.timedelta(seconds=seconds)
+        while True:
+            timer = self.next_timer()
+            if timer is None or timer.when > until:
+                break
+            self.step()
+        self.now = until
+
+
+class StoppableClock(SystemClock):
+    """
+    SystemClock keeping every timer it creates so that stop() can cancel them
+    all, including timers scheduled by refreshes already under way; timers
+    firing after stop() do nothing
+    """
+
+    def __init__(self):
+        self.timers = []
+        self.stopped = False
+
+    def timer(self, interval, function):
+        def run():
+            if not self.stopped:
+                function()
+
+        timer = super(StoppableClock, self).timer(interval, run)
+        self.timers.append(timer)
+        return timer
+
+    def stop(self):
+        self.stopped = True
+        while self.timers:
+            timer = self.timers.pop()
+            timer.cancel()
+            if timer.ident is not None:
+                # a refresh in progress may schedule another timer before exiting
+                timer.join()
+
+
+class StubCredentialsAdapter(requests.adapters.BaseAdapter):
+    """
+    requests transport answering AWS IoT credential requests with credentials
+    valid for ttl seconds of the clock's time, counting them and remembering
+    when the latest was issued and expires
+    """
+
+    def __init__(self, clock, ttl=DEFAULT_TTL):
+        super(StubCredentialsAdapter, self).__init__()
+        self.clock = clock
+        self.ttl = ttl
+        # only the latest, a growing record would count against memory growth
+        self.issued = 0
+        self.last_issued = None
+
+    def send(self, request, **kwargs):
+        now = self.clock.utcnow()
+        expiration = now + datetime.timedelta(seconds=self.ttl)
+        self.issued += 1
+        self.last_issued = (now, expiration)
+
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = request.url
+        response.request = request
+        response.encoding = "utf-8"
+        response._content = json.dumps({"credentials": {
+            "accessKeyId": "ASIASOAK%012d" % self.issued,
+            "secretAccessKey": "soak",
+            "sessionToken": "soak",
+            "expiration": expiration.strftime(botocore.auth.ISO8601),
+        }}).encode("utf-8")
+        return response
+
+    def close(self):
+        pass
+
+
+class SoakReport(object):
+    """
+    :param refresh_fractions: for each timer driven refresh, its delay as a fraction
+        of the lifetime of the credentials it replaced
+    :param int late_refreshes: timer driven refreshes at or after expiration
+    :param int thread_growth: most threads alive at once during the system clock phase
+        beyond those alive before it, None if that phase was skipped
+    """
+
+    def __init__(self, ttl, refresh_fractions, late_refreshes, max_pending_timers, thread_growth, memory_growth):
+        self.ttl = ttl
+        self.refresh_fractions = sorted(refresh_fractions)
+        self.late_refreshes = late_refreshes
+        self.max_pending_timers = max_pending_timers
+        self.thread_growth = thread_growth
+        self.memory_growth = memory_growth
+
+    @property
+    def rotations(self):
+        return len(self.refresh_fractions)
+
+    @property
+    def expected_window(self):
+        # see IotBotoCredentialProvider.get_refresh_seconds
+        low = REFRESH_FRACTION
+        return low, min(1.0, low + max(REFRESH_JITTER_FRACTION, float(MINIMUM_REFRESH_JITTER) / self.ttl))
+
+    @property
+    def out_of_window(self):
+        low, high = self.expected_window
+        return [f for f in self.refresh_fractions if f < low or f > high]
+
+    def percentile(self, p):
+        fractions = self.refresh_fractions
+        return fractions[min(len(fractions) - 1, int(round(p / 100.0 * (len(fractions) - 1))))]
+
+    def histogram(self, buckets=HISTOGRAM_BUCKETS):
+        low, high = self.expected_window
+        width = (high - low) / buckets
+        counts = [0] * buckets
+        for f in self.refresh_fractions:
+            counts[min(buckets - 1, max(0, int((f - low) / width)))] += 1
+        return [(low + i * width, low + (i + 1) * width, count) for i, count in enumerate(counts)]
+
+    @property
+    def max_memory_growth(self):
+        return MEMORY_GROWTH_ALLOWANCE + MAX_MEMORY_GROWTH_PER_ROTATION * self.rotations
+
+    def check(self, max_pending_timers=MAX_PENDING_TIMERS, max_memory_growth=None):
+        """
+        Raise SoakError if any refresh landed outside the expected window or
+        after expiration, or if timers, threads or memory grew without bound
+        """
+        if max_memory_growth is None:
+            max_memory_growth = self.max_memory_growth
+        problems = []
+        if self.rotations == 0:
+            problems.append("no rotations happened")
+        if self.out_of_window:
+            problems.append("%d refreshes outside %.3f-%.3f of lifetime" %
+                            ((len(self.out_of_window),) + self.expected_window))
+        if self.late_refreshes:
+            problems.append("%d refreshes after expiration" % self.late_refreshes)
+        if self.max_pending_timers > max_pending_timers:
+            problems.append("%d refresh timers pending at once" % self.max_pending_timers)
+        if self.thread_growth is not None and self.thread_growth > MAX_THREAD_GROWTH:
+            problems.append("thread count grew by %d" % self.thread_growth)
+        if self.memory_growth > max_memory_growth:
+            problems.append("memory grew by %d bytes" % self.memory_growth)
+        if problems:
+            raise SoakError("; ".join(problems))
+        return self
+
+    def format(self):
+        lines = ["%d rotations of %ds credentials" % (self.rotations, self.ttl),
+                 "max pending refresh timers: %d" % self.max_pending_timers,
+                 "thread growth: %s" % ("not measured" if self.thread_growth is None else self.thread_growth),
+                 "memory growth: %d bytes (limit %d)" % (self.memory_growth, self.max_memory_growth),
+                 "refreshes after expiration: %d" % self.late_refreshes,
+                 "refreshes outside %.3f-%.3f of lifetime: %d" %
+                 (self.expected_window + (len(self.out_of_window),))]
+        if self.rotations:
+            lines.append("refresh time as fraction of lifetime:")
+            for p in REPORT_PERCENTILES:
+                lines.append("  p%-3d %.4f" % (p, self.percentile(p)))
+            lines.append("histogram:")
+            for low, high, count in self.histogram():
+                lines.append("  %.3f-%.3f %7d %s" % (low, high, count, "#" * (50 * count // self.rotations)))
+        return "\n".join(lines)
+
+
+class SoakHarness(object):
+    """
+    Drive a FakeMetadataCredentialProvider through many rotations on a VirtualClock
+
+    .. code-block:: python
+
+        report = SoakHarness(ttl=3600).run(rotations=5000).check()
+        print(report.format())
+
+    :param int ttl: lifetime in seconds of credentials from the stub endpoint
+    :param int on_demand_every: also fetch credentials on demand every this many
+        rotations, as load() or an expired cache would, to exercise rescheduling
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, on_demand_every=7, provider_class=FakeMetadataCredentialProvider):
+        self.ttl = ttl
+        self.on_demand_every = on_demand_every
+        self.provider_class = provider_class
+        self.clock = VirtualClock()
+        self.adapter = StubCredentialsAdapter(self.clock, ttl=ttl)
+
+    def _make_provider(self, registration_dir, clock, adapter):
+        metadata = {
+            'account_id': '0123456789',
+            'certificate_id': 'soak',
+            'credential_endpoint': SOAK_ENDPOINT,
+            'device_name': 'soak',
+            'region': 'us-test-1',
+            'role_alias_name': 'SoakRole',
+        }
+        with open(os.path.join(registration_dir, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+
+        session = requests.Session()
+        # skip proxy/netrc environment lookups on every request, they dominate run time
+        session.trust_env = False
+        session.mount(SOAK_ENDPOINT, adapter)
+        return self.provider_class(registration_dir, clock=clock, session=session)
+
+    def run(self, rotations=DEFAULT_ROTATIONS, thread_rotations=DEFAULT_THREAD_ROTATIONS):
+        """
+        :param int rotations: rotations to simulate on the virtual clock
+        :param int thread_rotations: rotations of real refresh timers on the system clock,
+            taking about 0.7s each, 0 skips the thread count check
+        """
+        registration_dir = tempfile.mkdtemp(prefix="iotsoak")
+        # every refresh logs at INFO, thousands of records would swamp the
+        # report and count against memory wherever they are kept
+        log_level = log.level
+        log.setLevel(logging.WARNING)
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        try:
+            provider = self._make_provider(registration_dir, self.clock, self.adapter)
+            max_pending_timers = 0
+
+            # allocated up front so the harness's own records don't count as growth
+            refresh_fractions = array.array("d", bytes(8 * rotations))
+            late_refreshes = 0
+
+            provider.get_credentials()
+            baseline = None
+            for rotation in range(rotations):
+                if rotation == min(10, rotations) and baseline is None:
+                    baseline = tracemalloc.take_snapshot()
+                if self.on_demand_every and rotation % self.on_demand_every == 0:
+                    # an off-schedule fetch, the pending refresh must be replaced rather than duplicated
+                    provider.get_credentials()
+                max_pending_timers = max(max_pending_timers, self.clock.pending_timers)
+
+                issued, expiration = self.adapter.last_issued
+                if not self.clock.step():
+                    raise SoakError("no refresh scheduled after %d rotations" % rotation)
+                refreshed = self.clock.utcnow()
+                refresh_fractions[rotation] = (refreshed - issued).total_seconds() / \
+                    (expiration - issued).total_seconds()
+                if refreshed >= expiration:
+                    late_refreshes += 1
+
+            memory_growth = self._memory_growth(baseline)
+            provider.cancel_timer()
+
+            thread_growth = None
+            if thread_rotations:
+                thread_growth = self._run_threads(registration_dir, thread_rotations)
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+            log.setLevel(log_level)
+            shutil.rmtree(registration_dir)
+
+        return SoakReport(self.ttl, refresh_fractions, late_refreshes, max_pending_timers, thread_growth,
+                          memory_growth)
+
+    def _run_threads(self, registration_dir, rotations):
+        """
+        Refresh on real Timer threads, returns the most threads alive at once
+        beyond those alive before starting
+        """
+        clock = StoppableClock()
+        adapter = StubCredentialsAdapter(clock, ttl=THREAD_TTL)
+        provider = self._make_provider(registration_dir, clock, adapter)
+        threads_before = threading.active_count()
+        max_threads = threads_before
+        deadline = time.time() + rotations * THREAD_TTL * 2
+
+        try:
+            provider.get_credentials()
+            on_demand = 0
+            refreshes = 0
+            while refreshes < rotations:
+                refreshes = adapter.issued - 1 - on_demand
+                if self.on_demand_every and refreshes >= (on_demand + 1) * self.on_demand_every:
+                    on_demand += 1
+                    provider.get_credentials()
+                max_threads = max(max_threads, threading.active_count())
+                if time.time() > deadline:
+                    raise SoakError("only %d of %d real refreshes happened" % (refreshes, rotations))
+                time.sleep(THREAD_POLL_INTERVAL)
+        finally:
+            provider.cancel_timer()
+            clock.stop()
+
+        return max_threads - threads_before
+
+    def _memory_growth(self, baseline):
+        if baseline is None:
+            return 0
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+        return sum(stat.size_diff for stat in after.compare_to(baseline.filter_traces(filters), "filename"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="soak test credential refresh scheduling on a virtual clock")
+    parser.add_argument("--rotations", type=int, default=DEFAULT_ROTATIONS,
+                        help="number of credential rotations, defaults to %s" % DEFAULT_ROTATIONS)
+    parser.add_argument("--ttl", type=int, default=DEFAULT_TTL,
+                        help="credential lifetime in seconds, defaults to %s" % DEFAULT_TTL)
+    parser.add_argument("--thread-rotations", type=int, default=DEFAULT_THREAD_ROTATIONS, dest="thread_rotations",
+                        help="rotations on real timer threads, about 0.7s each, 0 disables, "
+                             "defaults to %s" % DEFAULT_THREAD_ROTATIONS)
+    parser.add_argument("--on-demand-every", type=int, default=7, dest="on_demand_every",
+                        help="also fetch on demand every N rotations, 0 disables")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig()
+    report = SoakHarness(ttl=args.ttl, on_demand_every=args.on_demand_every).run(args.rotations,
+                                                                                args.thread_rotations)
+    print(report.format())
+    try:
+        report.check()
+    except SoakError as e:
+        print("FAILED: %s" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
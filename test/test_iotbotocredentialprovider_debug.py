@@ -0,0 +1,172 @@
+import io
+import pytest
+import mock
+import threading
+import time
+import requests
+import iotbotocredentialprovider.Debug
+import iotbotocredentialprovider.FakeMetadata
+
+
+def busy(n):
+    return sum(range(n))
+
+
+class TestRequestProfiler(object):
+    def setup_method(self):
+        self.profiler = iotbotocredentialprovider.Debug.RequestProfiler()
+
+    def test_runcall_inactive(self):
+        assert self.profiler.active is False
+        assert self.profiler.runcall(busy, 10) == 45
+        assert self.profiler.requests == 0
+
+    def test_profile_window(self):
+        def make_requests():
+            time.sleep(0.2)
+            for _ in range(3):
+                self.profiler.runcall(busy, 1000)
+
+        t = threading.Thread(target=make_requests)
+        t.start()
+        report = self.profiler.profile(1, sort="cumulative", limit=5)
+        t.join()
+
+        assert report.startswith("profiled 3 requests")
+        assert "busy" in report
+        assert self.profiler.active is False
+
+
+class TestFakeMetadataRequestProfiling(object):
+    def setup_method(self):
+        handler_class = iotbotocredentialprovider.FakeMetadata.FakeMetadataRequestHandler
+        self.profiler = iotbotocredentialprovider.Debug.RequestProfiler()
+        self.patchers = [mock.patch.object(handler_class, "profiler", self.profiler),
+                         mock.patch.object(handler_class, "credential_provider", mock.Mock(role_name="TestRole"))]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def teardown_method(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def make_handler(self, path):
+        handler_class = iotbotocredentialprovider.FakeMetadata.FakeMetadataRequestHandler
+        handler = handler_class.__new__(handler_class)
+        handler.path = path
+        handler.client_address = (iotbotocredentialprovider.FakeMetadata.UNIX_SOCKET_CLIENT, 0)
+        handler.command = "GET"
+        handler.request_version = "HTTP/1.0"
+        handler.requestline = "GET %s HTTP/1.0" % path
+        handler.wfile = io.BytesIO()
+        handler.log_message = mock.Mock()
+        return handler
+
+    def test_profile_requests(self):
+        handler = self.make_handler(iotbotocredentialprovider.FakeMetadata.PING_PATH)
+        t = threading.Timer(0.2, handler.do_GET)
+        t.start()
+        report = self.profiler.profile(1)
+        t.join()
+        assert report.startswith("profiled 1 requests")
+        assert "handle_get" in report
+        assert handler.wfile.getvalue().endswith(b"pong")
+
+    def test_rotation_not_profiled(self):
+        rotation = self.make_handler(iotbotocredentialprovider.FakeMetadata.ROTATION_PATH + "?since=1")
+        # stands in for a long-poll waiting on the next rotation
+        rotation.handle_get = lambda: time.sleep(1)
+        ping = self.make_handler(iotbotocredentialprovider.FakeMetadata.PING_PATH)
+        timings = {}
+
+        def make_requests():
+            time.sleep(0.1)
+            rotation_thread = threading.Thread(target=rotation.do_GET)
+            rotation_thread.start()
+            time.sleep(0.1)
+            start = time.time()
+            ping.do_GET()
+            timings["ping"] = time.time() - start
+            rotation_thread.join()
+
+        t = threading.Thread(target=make_requests)
+        t.start()
+        report = self.profiler.profile(0.5)
+        t.join()
+        assert timings["ping"] < 0.5
+        assert report.startswith("profiled 1 requests")
+
+
+class TestDebugFunctions(object):
+    def test_tracemalloc_diff(self):
+        report = iotbotocredentialprovider.Debug.tracemalloc_diff(0.1, limit=5)
+        assert report.startswith("traced memory current=")
+        assert "top 5 differences" in report
+
+    def test_tracemalloc_diff_concurrent(self):
+        results = []
+        t = threading.Thread(target=lambda: results.append(
+            iotbotocredentialprovider.Debug.tracemalloc_diff(0.3, limit=1)))
+        t.start()
+        time.sleep(0.1)
+        results.append(iotbotocredentialprovider.Debug.tracemalloc_diff(0.1, limit=1))
+        t.join()
+        assert len(results) == 2
+
+    def test_dump_threads(self):
+        t = threading.Timer(10, busy, args=(1,))
+        t.name = "FakeMetadataRefreshTimer"
+        t.start()
+        try:
+            report = iotbotocredentialprovider.Debug.dump_threads()
+        finally:
+            t.cancel()
+        assert "Thread MainThread" in report
+        assert "Thread FakeMetadataRefreshTimer" in report
+        assert "test_dump_threads" in report
+
+
+class TestFakeMetadataDebugServer(object):
+    def setup_method(self):
+        self.profiler = iotbotocredentialprovider.Debug.RequestProfiler()
+        self.server = iotbotocredentialprovider.Debug.FakeMetadataDebugServer(self.profiler, port=0)
+        self.server.start()
+        self.url = "http://127.0.0.1:%d" % self.server.port
+
+    def teardown_method(self):
+        self.server.stop()
+
+    def test_loopback_only(self):
+        with pytest.raises(ValueError):
+            iotbotocredentialprovider.Debug.FakeMetadataDebugServer(self.profiler, host="0.0.0.0", port=0)
+
+    def test_threads(self):
+        response = requests.get(self.url + "/debug/threads")
+        assert response.status_code == 200
+        assert "FakeMetadataDebugServer" in response.text
+
+    def test_profile(self):
+        response = requests.get(self.url + "/debug/profile?seconds=0.1")
+        assert response.status_code == 200
+        assert response.text.startswith("profiled 0 requests")
+
+    def test_bad_sort(self):
+        # rejected at once, not after a window in which nothing was profiled
+        start = time.time()
+        response = requests.get(self.url + "/debug/profile?seconds=60&sort=nosuchkey")
+        assert time.time() - start < 5
+        assert response.status_code == 400
+
+    def test_tracemalloc(self):
+        response = requests.get(self.url + "/debug/tracemalloc?seconds=0.1&limit=3")
+        assert response.status_code == 200
+        assert "top 3 allocations" in response.text
+
+    @pytest.mark.parametrize("query", ["frames=0", "frames=1000", "limit=0", "limit=-1", "frames=x"])
+    def test_bad_parameters(self, query):
+        response = requests.get(self.url + "/debug/tracemalloc?seconds=0&" + query)
+        assert response.status_code == 400
+
+    def test_not_found(self):
+        response = requests.get(self.url + "/debug/nosuchthing")
+        assert response.status_code == 404
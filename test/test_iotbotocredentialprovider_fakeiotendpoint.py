@@ -0,0 +1,85 @@
+import datetime
+import pytest
+import os
+import shutil
+import ssl
+import tempfile
+import time
+import requests
+import iotbotocredentialprovider.AWS
+import iotbotocredentialprovider.FakeIotEndpoint
+
+
+pytestmark = pytest.mark.skipif(shutil.which(iotbotocredentialprovider.FakeIotEndpoint.OPENSSL) is None,
+                                reason="openssl is needed to issue test certificates")
+
+
+class TestFakeIotCredentialsEndpoint(object):
+    def setup_method(self):
+        self.registration_dir = tempfile.mkdtemp()
+        self.endpoint = iotbotocredentialprovider.FakeIotEndpoint.FakeIotCredentialsEndpoint(ttl=900, seed=1)
+        self.endpoint.start()
+        self.metadata = self.endpoint.register_device(self.registration_dir, device_name="test1")
+        self.cp = iotbotocredentialprovider.AWS.IotBotoCredentialProvider(self.registration_dir,
+                                                                           verify=self.endpoint.ca_file)
+
+    def teardown_method(self):
+        self.endpoint.stop()
+        shutil.rmtree(self.registration_dir)
+
+    def test_register_device(self):
+        certificate_id = self.metadata['certificate_id']
+        assert os.path.exists(os.path.join(self.registration_dir, "%s.pem" % certificate_id))
+        assert os.path.exists(os.path.join(self.registration_dir, "%s.privatekey" % certificate_id))
+        assert self.cp.metadata['credential_endpoint'] == self.endpoint.url
+
+    def test_register_device_not_started(self):
+        endpoint = iotbotocredentialprovider.FakeIotEndpoint.FakeIotCredentialsEndpoint(
+            certificate_authority=self.endpoint.certificate_authority)
+        with pytest.raises(iotbotocredentialprovider.FakeIotEndpoint.FakeIotEndpointError):
+            endpoint.register_device(self.registration_dir)
+
+    def test_get_credentials(self):
+        credentials = self.cp.get_credentials()
+        assert credentials['accessKeyId'].startswith("ASIA")
+        ttl = self.cp._credential_expiration - datetime.datetime.utcnow()
+        assert 800 < ttl.total_seconds() <= 900
+        assert self.endpoint.requests == [("/role-aliases/TestRole/credentials", "test1")]
+
+    def test_client_certificate_required(self):
+        with pytest.raises(requests.exceptions.RequestException):
+            requests.get(self.endpoint.url + "/role-aliases/TestRole/credentials",
+                         headers={"x-amzn-iot-thingname": "test1"}, verify=self.endpoint.ca_file)
+
+    def test_handshake_errors_not_printed(self, capsys):
+        try:
+            raise ssl.SSLError("peer did not return a certificate")
+        except ssl.SSLError:
+            self.endpoint.server.handle_error(None, ("127.0.0.1", 12345))
+        assert "Traceback" not in capsys.readouterr().err
+
+    def test_untrusted_endpoint(self):
+        cp = iotbotocredentialprovider.AWS.IotBotoCredentialProvider(self.registration_dir)
+        with pytest.raises(requests.exceptions.SSLError):
+            cp.get_credentials()
+
+    def test_unknown_role_alias(self):
+        self.endpoint.role_alias_name = "OtherRole"
+        with pytest.raises(iotbotocredentialprovider.AWS.IotBotoCredentialProviderError):
+            self.cp.get_credentials()
+
+    def test_error_rate(self):
+        self.endpoint.error_rate = 1
+        with pytest.raises(iotbotocredentialprovider.AWS.IotBotoCredentialProviderError):
+            self.cp.get_credentials()
+
+    def test_malformed_body(self):
+        self.endpoint.malformed_rate = 1
+        with pytest.raises(ValueError):
+            self.cp.get_credentials()
+
+    def test_latency(self):
+        self.endpoint.latency = 0.5
+        start = time.time()
+        self.cp.get_credentials()
+        assert time.time() - start >= 0.5
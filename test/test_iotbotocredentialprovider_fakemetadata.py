@@ -5,11 +5,15 @@ from copy import deepcopy
 import os
 import json
 import shutil
+import stat
 import tempfile
+import threading
 import time
 import botocore.auth
+import botocore.credentials
 import iotbotocredentialprovider.AWS
 import iotbotocredentialprovider.FakeMetadata
+import iotbotocredentialprovider.Soak
 
 
 metadata = {
@@ -29,6 +33,17 @@ fake_credentials = {
 }
 
 
+def slow_credentials_response(*args, **kwargs):
+    time.sleep(0.01)
+    credentials = deepcopy(fake_credentials)
+    expire_time = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    credentials['expiration'] = expire_time.strftime(botocore.auth.ISO8601)
+    response = mock.Mock()
+    response.status_code = 200
+    response.text = json.dumps({"credentials": credentials})
+    return response
+
+
 class TestFakeMetadata(object):
     def setup(self):
         self.registration_dir = tempfile.mkdtemp()
@@ -92,3 +107,247 @@ class TestFakeMetadata(object):
         refresh = self.cp.get_refresh_seconds()
         assert refresh > 0.7*3600
         assert refresh < 3600
+
+
+class TestFakeMetadataRotation(object):
+    def setup_method(self):
+        self.registration_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.registration_dir, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+
+        self.cp = iotbotocredentialprovider.FakeMetadata.FakeMetadataCredentialProvider(self.registration_dir)
+
+    def teardown_method(self):
+        self.cp.cancel_timer()
+        shutil.rmtree(self.registration_dir)
+
+    @mock.patch.object(iotbotocredentialprovider.FakeMetadata.FakeMetadataCredentialProvider, "update_timer")
+    @mock.patch.object(iotbotocredentialprovider.AWS.IotBotoCredentialProvider, "get_credentials")
+    def test_rotation_sequence(self, mock_get_credentials, mock_update_timer):
+        mock_get_credentials.return_value = fake_credentials
+        self.cp._credential_expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        assert self.cp.rotation_sequence == 0
+        self.cp.get_credentials()
+        assert self.cp.rotation_sequence == 1
+        assert mock_update_timer.called is True
+
+    def test_wait_for_rotation_timeout(self):
+        start = time.time()
+        assert self.cp.wait_for_rotation(since=0, timeout=0.5) == 0
+        assert time.time() - start >= 0.5
+
+    @mock.patch.object(iotbotocredentialprovider.FakeMetadata.FakeMetadataCredentialProvider, "update_timer")
+    @mock.patch.object(iotbotocredentialprovider.AWS.IotBotoCredentialProvider, "get_credentials")
+    def test_rotation_event(self, mock_get_credentials, mock_update_timer):
+        self.cp._credentials = fake_credentials
+        self.cp._credential_expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        mock_get_credentials.return_value = fake_credentials
+
+        timer = threading.Timer(0.5, self.cp.get_credentials)
+        timer.start()
+        event = self.cp.rotation_event(since=0, timeout=5)
+        timer.join()
+
+        assert event["Sequence"] == 1
+        assert event["Rotated"] is True
+        assert event["AccessKeyId"] == fake_credentials['accessKeyId']
+        assert event["Expiration"] == fake_credentials['expiration']
+
+        event = self.cp.rotation_event(since=1, timeout=0)
+        assert event["Sequence"] == 1
+        assert event["Rotated"] is False
+
+        # a client whose counter is ahead, e.g. from before a server restart, is answered at once
+        start = time.time()
+        event = self.cp.rotation_event(since=5, timeout=5)
+        assert time.time() - start < 1
+        assert event["Sequence"] == 1
+        assert event["Rotated"] is True
+        assert event["AccessKeyId"] == fake_credentials['accessKeyId']
+
+    def test_rotation_event_no_credentials(self):
+        event = self.cp.rotation_event()
+        assert event == {"Sequence": 0, "Rotated": False}
+        event = self.cp.rotation_event(since=3, timeout=0.1)
+        assert event == {"Sequence": 0, "Rotated": False}
+
+    def run_concurrently(self, function, count=20):
+        errors = []
+
+        def run():
+            try:
+                function()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return errors
+
+    @mock.patch("requests.get", side_effect=slow_credentials_response)
+    def test_concurrent_requests_fetch_once(self, mock_requests_get):
+        errors = self.run_concurrently(lambda: self.cp.credentials)
+
+        assert errors == []
+        assert mock_requests_get.call_count == 1
+        assert self.cp.rotation_sequence == 1
+        assert self.cp._update_timer.is_alive()
+
+    @mock.patch("requests.get", side_effect=slow_credentials_response)
+    def test_concurrent_fetches_each_rotate(self, mock_requests_get):
+        # widen the gap between scheduling a refresh and starting its timer
+        with mock.patch.object(iotbotocredentialprovider.FakeMetadata.logging, "info",
+                               side_effect=lambda *args: time.sleep(0.02)):
+            errors = self.run_concurrently(self.cp.get_credentials)
+
+        assert errors == []
+        assert mock_requests_get.call_count == 20
+        assert self.cp.rotation_sequence == 20
+        assert self.cp._update_timer.is_alive()
+
+
+class TestFakeMetadataUnixSocket(object):
+    def setup_method(self):
+        self.registration_dir = tempfile.mkdtemp()
+        self.metadata_file = os.path.join(self.registration_dir, "metadata.json")
+        self.socket_path = os.path.join(self.registration_dir, "metadata.sock")
+
+        with open(self.metadata_file, "w") as f:
+            json.dump(metadata, f)
+
+        expire_time = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        self.cp = iotbotocredentialprovider.FakeMetadata.FakeMetadataCredentialProvider(self.registration_dir)
+        self.cp._credentials = deepcopy(fake_credentials)
+        self.cp._credentials['expiration'] = expire_time.strftime(botocore.auth.ISO8601)
+        self.cp._credential_expiration = expire_time
+
+        self.patcher = mock.patch.object(iotbotocredentialprovider.FakeMetadata.FakeMetadataRequestHandler,
+                                         "credential_provider", self.cp)
+        self.patcher.start()
+
+        self.server = iotbotocredentialprovider.FakeMetadata.FakeMetadataServer(
+            iotbotocredentialprovider.FakeMetadata.FakeMetadataRequestHandler,
+            host="127.0.0.1", port=0, unix_socket_path=self.socket_path)
+        self.server_thread = threading.Thread(target=self.server.run)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def teardown_method(self):
+        self.server.stop()
+        self.server_thread.join()
+        self.patcher.stop()
+        shutil.rmtree(self.registration_dir)
+
+    def test_get_role(self):
+        client = iotbotocredentialprovider.FakeMetadata.FakeMetadataSocketClient(self.socket_path)
+        assert client.get_role() == metadata['role_alias_name']
+
+    def test_get_credentials(self):
+        client = iotbotocredentialprovider.FakeMetadata.FakeMetadataSocketClient(self.socket_path)
+        credentials = client.get_credentials()
+        assert credentials['AccessKeyId'] == fake_credentials['accessKeyId']
+        assert credentials['Token'] == fake_credentials['sessionToken']
+
+    def test_not_found(self):
+        client = iotbotocredentialprovider.FakeMetadata.FakeMetadataSocketClient(self.socket_path)
+        with pytest.raises(iotbotocredentialprovider.AWS.IotBotoCredentialProviderError):
+            client.get("/nosuchpath")
+
+    def test_credential_provider_load(self):
+        provider = iotbotocredentialprovider.FakeMetadata.FakeMetadataSocketCredentialProvider(self.socket_path)
+        credentials = provider.load()
+        assert isinstance(credentials, botocore.credentials.RefreshableCredentials)
+        assert credentials.access_key == fake_credentials['accessKeyId']
+
+    def test_socket_mode(self):
+        assert stat.S_IMODE(os.stat(self.socket_path).st_mode) == 0o660
+
+    def test_refuses_non_socket_path(self):
+        path = os.path.join(self.registration_dir, "notasocket")
+        with open(path, "w") as f:
+            f.write("keep me")
+        with pytest.raises(ValueError):
+            iotbotocredentialprovider.FakeMetadata.FakeMetadataServer(
+                iotbotocredentialprovider.FakeMetadata.FakeMetadataRequestHandler,
+                host="127.0.0.1", port=0, unix_socket_path=path)
+        assert open(path).read() == "keep me"
+
+    def test_socket_group(self):
+        path = os.path.join(self.registration_dir, "group.sock")
+        gid = os.getgid()
+        server = iotbotocredentialprovider.FakeMetadata.FakeMetadataServer(
+            iotbotocredentialprovider.FakeMetadata.FakeMetadataRequestHandler,
+            host="127.0.0.1", port=0, unix_socket_path=path, unix_socket_mode=0o600,
+            unix_socket_group=str(gid))
+        try:
+            assert os.stat(path).st_gid == gid
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        finally:
+            server.unix_server.server_close()
+            server.server.server_close()
+
+    @mock.patch("os.umask")
+    def test_socket_mode_leaves_umask(self, mock_umask):
+        path = os.path.join(self.registration_dir, "umask.sock")
+        server = iotbotocredentialprovider.FakeMetadata.FakeMetadataServer(
+            iotbotocredentialprovider.FakeMetadata.FakeMetadataRequestHandler,
+            host="127.0.0.1", port=0, unix_socket_path=path, unix_socket_mode=0o600)
+        try:
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+            assert mock_umask.called is False
+        finally:
+            server.unix_server.server_close()
+            server.server.server_close()
+
+    def test_unknown_socket_group(self):
+        path = os.path.join(self.registration_dir, "nogroup.sock")
+        with pytest.raises(KeyError):
+            iotbotocredentialprovider.FakeMetadata.FakeMetadataServer(
+                iotbotocredentialprovider.FakeMetadata.FakeMetadataRequestHandler,
+                host="127.0.0.1", port=0, unix_socket_path=path, unix_socket_group="nosuchgroup")
+        assert not os.path.exists(path)
+
+    def test_stop_removes_socket(self):
+        assert os.path.exists(self.socket_path)
+        self.server.stop()
+        assert not os.path.exists(self.socket_path)
+
+
+class TestFakeMetadataRefresh(object):
+    def setup_method(self):
+        self.registration_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.registration_dir, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+
+        self.clock = iotbotocredentialprovider.Soak.VirtualClock()
+        self.cp = iotbotocredentialprovider.FakeMetadata.FakeMetadataCredentialProvider(self.registration_dir,
+                                                                                          clock=self.clock)
+
+    def teardown_method(self):
+        shutil.rmtree(self.registration_dir)
+
+    def test_get_refresh_seconds_long_lived(self):
+        self.cp._credential_expiration = self.clock.utcnow() + datetime.timedelta(days=2, hours=1)
+        refresh = self.cp.get_refresh_seconds()
+        assert refresh > 0.7 * 49 * 3600
+        assert refresh < 0.8 * 49 * 3600
+
+    def test_get_refresh_seconds_expired(self):
+        self.cp._credential_expiration = self.clock.utcnow() - datetime.timedelta(minutes=5)
+        assert self.cp.get_refresh_seconds() < 30
+
+    @mock.patch.object(iotbotocredentialprovider.FakeMetadata.FakeMetadataCredentialProvider, "get_credentials")
+    def test_update_timer_replaces_pending(self, mock_get_credentials):
+        self.cp.update_timer(refresh_time_seconds=1)
+        first_timer = self.cp._update_timer
+        self.cp.update_timer(refresh_time_seconds=60)
+        self.clock.advance(2)
+        assert mock_get_credentials.called is False
+        assert not first_timer.is_alive()
+        assert self.clock.pending_timers == 1
+
+        self.clock.advance(60)
+        assert mock_get_credentials.call_count == 1
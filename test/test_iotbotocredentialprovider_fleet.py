@@ -0,0 +1,218 @@
+import datetime
+import pytest
+import mock
+from copy import deepcopy
+import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+import boto3
+import botocore.auth
+import iotbotocredentialprovider.AWS
+import iotbotocredentialprovider.Fleet
+
+
+metadata = {
+    'account_id': '0123456789',
+    'certificate_id': 'mycertificateid',
+    'credential_endpoint': 'https://xyzzy.credentials.iot.us-east-1.amazonaws.com',
+    'device_name': 'test1',
+    'region': 'us-test-1',
+    'role_alias_name': 'TestRole'
+}
+
+fake_credentials = {
+    'accessKeyId': 'MyAccessKey',
+    'expiration': '2018-03-12T03:52:05Z',
+    'secretAccessKey': 'MySecretAccessKey',
+    'sessionToken': 'MySessionToken',
+}
+
+
+def fake_get_credentials(self):
+    expire_time = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    self._credentials = deepcopy(fake_credentials)
+    self._credentials['expiration'] = expire_time.strftime(botocore.auth.ISO8601)
+    self._credential_expiration = expire_time
+    return self._credentials
+
+
+class TestIotCredentialFleet(object):
+    def setup_method(self):
+        self.root_dir = tempfile.mkdtemp()
+        for thing in ["thing1", "thing2", "thing3"]:
+            os.mkdir(os.path.join(self.root_dir, thing))
+            thing_metadata = deepcopy(metadata)
+            thing_metadata['device_name'] = thing
+            with open(os.path.join(self.root_dir, thing, "metadata.json"), "w") as f:
+                json.dump(thing_metadata, f)
+        os.mkdir(os.path.join(self.root_dir, "notathing"))
+
+        self.fleet = iotbotocredentialprovider.Fleet.IotCredentialFleet(self.root_dir, max_workers=2,
+                                                                         stagger_seconds=1)
+
+    def teardown_method(self):
+        self.fleet.stop()
+        shutil.rmtree(self.root_dir)
+
+    def test_discover(self):
+        assert self.fleet.discover() == ["thing1", "thing2", "thing3"]
+        assert len(self.fleet) == 3
+        assert "thing2" in self.fleet
+        assert self.fleet.get_provider("thing2").path == os.path.join(self.root_dir, "thing2")
+
+    def test_discover_removed(self):
+        self.fleet.discover()
+        shutil.rmtree(os.path.join(self.root_dir, "thing2"))
+        assert self.fleet.discover() == ["thing1", "thing3"]
+
+    def test_discover_skips_bad_metadata(self):
+        with open(os.path.join(self.root_dir, "notathing", "metadata.json"), "w") as f:
+            f.write("{")
+        assert self.fleet.discover() == ["thing1", "thing2", "thing3"]
+
+    def test_duplicate_thing(self):
+        self.fleet.discover()
+        other_dir = os.path.join(self.root_dir, "notathing")
+        thing_metadata = deepcopy(metadata)
+        thing_metadata['device_name'] = "thing1"
+        with open(os.path.join(other_dir, "metadata.json"), "w") as f:
+            json.dump(thing_metadata, f)
+
+        with pytest.raises(iotbotocredentialprovider.Fleet.IotCredentialFleetError):
+            self.fleet.add_path(other_dir)
+
+    def test_unknown_thing(self):
+        with pytest.raises(iotbotocredentialprovider.Fleet.IotCredentialFleetError):
+            self.fleet.get_provider("nosuchthing")
+
+    def test_get_boto3_session(self):
+        self.fleet.discover()
+        bs = self.fleet.get_boto3_session("thing1")
+        assert isinstance(bs, boto3.session.Session)
+        assert bs.region_name == metadata['region']
+
+    @mock.patch.object(iotbotocredentialprovider.AWS.IotBotoCredentialProvider, "get_credentials",
+                       autospec=True, side_effect=fake_get_credentials)
+    def test_refresh_all(self, mock_get_credentials):
+        self.fleet.discover()
+        self.fleet.refresh_all()
+        assert mock_get_credentials.call_count == 3
+        for thing in self.fleet.thing_names:
+            assert self.fleet.get_credentials(thing)['accessKeyId'] == fake_credentials['accessKeyId']
+
+    @mock.patch.object(iotbotocredentialprovider.AWS.IotBotoCredentialProvider, "get_credentials",
+                       autospec=True, side_effect=fake_get_credentials)
+    def test_get_refresh_seconds(self, mock_get_credentials):
+        self.fleet.discover()
+        self.fleet.refresh("thing1")
+        refresh = self.fleet.get_refresh_seconds("thing1")
+        assert refresh > 0.7*3600 - 5
+        assert refresh < 0.8*3600
+
+    @mock.patch.object(iotbotocredentialprovider.AWS.IotBotoCredentialProvider, "get_credentials",
+                       autospec=True, side_effect=iotbotocredentialprovider.AWS.IotBotoCredentialProviderError("denied"))
+    def test_refresh_failure_retries(self, mock_get_credentials):
+        self.fleet.discover()
+        self.fleet.start()
+        self.fleet.refresh("thing1")
+        assert self.fleet._next_refresh["thing1"] - time.time() < 2 * self.fleet.retry_seconds
+
+    @mock.patch.object(iotbotocredentialprovider.AWS.IotBotoCredentialProvider, "get_credentials",
+                       autospec=True, side_effect=fake_get_credentials)
+    def test_start_staggers_refresh(self, mock_get_credentials):
+        self.fleet.discover()
+        self.fleet.start()
+        time.sleep(2)
+        assert mock_get_credentials.call_count == 3
+        # next refreshes are scheduled well into the future
+        for thing in self.fleet.thing_names:
+            assert self.fleet._next_refresh[thing] - time.time() > 0.7*3600 - 5
+
+    @mock.patch.object(iotbotocredentialprovider.AWS.IotBotoCredentialProvider, "get_credentials",
+                       autospec=True, side_effect=fake_get_credentials)
+    def test_concurrent_refresh_and_lookup(self, mock_get_credentials):
+        self.fleet.discover()
+        self.fleet.refresh("thing1")
+        errors = []
+        done = threading.Event()
+
+        def lookup():
+            while not done.is_set():
+                try:
+                    self.fleet.get_credentials("thing1")
+                except Exception as e:
+                    errors.append(e)
+
+        t = threading.Thread(target=lookup)
+        t.start()
+        for _ in range(2000):
+            self.fleet.refresh("thing1")
+        done.set()
+        t.join()
+        assert errors == []
+
+    @mock.patch.object(iotbotocredentialprovider.AWS.IotBotoCredentialProvider, "get_credentials",
+                       autospec=True, side_effect=fake_get_credentials)
+    def test_session_uses_fleet_credentials(self, mock_get_credentials):
+        self.fleet.discover()
+        self.fleet.refresh("thing1")
+        assert mock_get_credentials.call_count == 1
+
+        credentials = self.fleet.get_botocore_session("thing1").get_credentials()
+        assert credentials.access_key == fake_credentials['accessKeyId']
+        # botocore refreshing the session hands back the fleet's cached credentials
+        credentials._refresh_using()
+        assert mock_get_credentials.call_count == 1
+
+    @mock.patch.object(iotbotocredentialprovider.AWS.IotBotoCredentialProvider, "get_credentials",
+                       autospec=True)
+    def test_refresh_removed_thing(self, mock_get_credentials):
+        self.fleet.discover()
+
+        def remove_during_fetch(provider):
+            self.fleet.remove("thing1")
+            return fake_get_credentials(provider)
+
+        mock_get_credentials.side_effect = remove_during_fetch
+        self.fleet.refresh_all()
+        assert "thing1" not in self.fleet
+
+    @mock.patch("requests.get")
+    def test_concurrent_expired_lookups_fetch_once(self, mock_requests_get):
+        def slow_get(*args, **kwargs):
+            time.sleep(0.2)
+            credentials = deepcopy(fake_credentials)
+            expire_time = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+            credentials['expiration'] = expire_time.strftime(botocore.auth.ISO8601)
+            response = mock.Mock()
+            response.status_code = 200
+            response.text = json.dumps({"credentials": credentials})
+            return response
+
+        mock_requests_get.side_effect = slow_get
+        self.fleet.discover()
+        errors = []
+
+        def lookup():
+            try:
+                self.fleet.get_credentials("thing1")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=lookup) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert mock_requests_get.call_count == 1
+
+    def test_unknown_thing_session(self):
+        with pytest.raises(iotbotocredentialprovider.Fleet.IotCredentialFleetError):
+            self.fleet.get_boto3_session("nosuchthing")
+
+    def test_stop_not_started(self):
+        self.fleet.stop()
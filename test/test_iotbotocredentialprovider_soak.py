@@ -0,0 +1,115 @@
+import datetime
+import pytest
+import threading
+import iotbotocredentialprovider.FakeMetadata
+import iotbotocredentialprovider.Soak
+
+
+class LeakyTimerCredentialProvider(iotbotocredentialprovider.FakeMetadata.FakeMetadataCredentialProvider):
+    # reschedules without cancelling the pending refresh, as update_timer used to
+    def cancel_timer(self):
+        pass
+
+
+class TimerHoardingCredentialProvider(iotbotocredentialprovider.FakeMetadata.FakeMetadataCredentialProvider):
+    # cancels its timers but keeps every one of them
+    def update_timer(self, refresh_time_seconds=300):
+        super(TimerHoardingCredentialProvider, self).update_timer(refresh_time_seconds)
+        self.__dict__.setdefault("timers", []).append(self._update_timer)
+
+
+class SecondsWrapCredentialProvider(iotbotocredentialprovider.FakeMetadata.FakeMetadataCredentialProvider):
+    # measures remaining lifetime with timedelta.seconds, as get_refresh_seconds used to
+    def get_refresh_seconds(self):
+        expiration = (self._credential_expiration - self.clock.utcnow()).seconds
+        return 0.7 * expiration
+
+
+class TestVirtualClock(object):
+    def setup_method(self):
+        self.clock = iotbotocredentialprovider.Soak.VirtualClock()
+        self.fired = []
+
+    def test_advance(self):
+        start = self.clock.utcnow()
+        self.clock.timer(20, lambda: self.fired.append(20)).start()
+        self.clock.timer(10, lambda: self.fired.append(10)).start()
+        self.clock.timer(60, lambda: self.fired.append(60)).start()
+        assert self.clock.pending_timers == 3
+
+        self.clock.advance(30)
+        assert self.fired == [10, 20]
+        assert self.clock.utcnow() == start + datetime.timedelta(seconds=30)
+        assert self.clock.pending_timers == 1
+
+    def test_cancel(self):
+        timer = self.clock.timer(10, lambda: self.fired.append(10))
+        timer.start()
+        timer.cancel()
+        assert self.clock.step() is False
+        assert self.fired == []
+
+
+class TestSoakHarness(object):
+    def test_soak(self):
+        report = iotbotocredentialprovider.Soak.SoakHarness(ttl=3600).run(rotations=1000, thread_rotations=3).check()
+        assert report.rotations == 1000
+        assert report.max_pending_timers == 1
+        assert report.thread_growth <= iotbotocredentialprovider.Soak.MAX_THREAD_GROWTH
+        assert 0.7 <= report.percentile(0) <= report.percentile(100) <= 0.8
+        assert sum(count for _, _, count in report.histogram()) == 1000
+        assert "1000 rotations of 3600s credentials" in report.format()
+
+    def test_soak_long_lived_credentials(self):
+        iotbotocredentialprovider.Soak.SoakHarness(ttl=3 * 86400).run(rotations=200, thread_rotations=0).check()
+
+    def test_soak_short_lived_credentials(self):
+        # the 30 second minimum jitter widens the window for short lifetimes, up to expiration
+        report = iotbotocredentialprovider.Soak.SoakHarness(ttl=60).run(rotations=200, thread_rotations=0).check()
+        assert report.expected_window == (0.7, 1.0)
+        assert report.late_refreshes == 0
+
+    def test_detects_leaked_timers(self):
+        harness = iotbotocredentialprovider.Soak.SoakHarness(provider_class=LeakyTimerCredentialProvider)
+        with pytest.raises(iotbotocredentialprovider.Soak.SoakError) as e:
+            harness.run(rotations=200, thread_rotations=0).check()
+        assert "refresh timers pending" in str(e.value)
+
+    def test_detects_memory_growth(self):
+        harness = iotbotocredentialprovider.Soak.SoakHarness(provider_class=TimerHoardingCredentialProvider)
+        report = harness.run(rotations=1000, thread_rotations=0)
+        assert report.max_pending_timers == 1
+        with pytest.raises(iotbotocredentialprovider.Soak.SoakError) as e:
+            report.check()
+        assert "memory grew" in str(e.value)
+
+    def test_memory_limit_scales_with_rotations(self):
+        short = iotbotocredentialprovider.Soak.SoakHarness().run(rotations=100, thread_rotations=0)
+        long = iotbotocredentialprovider.Soak.SoakHarness().run(rotations=1000, thread_rotations=0)
+        assert long.max_memory_growth > short.max_memory_growth
+        assert long.memory_growth <= long.max_memory_growth
+
+    def test_detects_thread_growth(self):
+        # every on-demand fetch leaves another chain of real timer threads behind
+        harness = iotbotocredentialprovider.Soak.SoakHarness(on_demand_every=1,
+                                                             provider_class=LeakyTimerCredentialProvider)
+        report = harness.run(rotations=10, thread_rotations=4)
+        assert report.thread_growth > iotbotocredentialprovider.Soak.MAX_THREAD_GROWTH
+        # the leaked timers are all stopped with the run
+        assert not [t for t in threading.enumerate() if t.name == "FakeMetadataRefreshTimer"]
+        with pytest.raises(iotbotocredentialprovider.Soak.SoakError) as e:
+            report.check()
+        assert "thread count grew" in str(e.value)
+
+    def test_detects_seconds_wrap(self):
+        harness = iotbotocredentialprovider.Soak.SoakHarness(ttl=2 * 86400, on_demand_every=0,
+                                                             provider_class=SecondsWrapCredentialProvider)
+        with pytest.raises(iotbotocredentialprovider.Soak.SoakError) as e:
+            harness.run(rotations=50, thread_rotations=0).check()
+        assert "outside" in str(e.value)
+
+    def test_main(self, capsys):
+        assert iotbotocredentialprovider.Soak.main(["--rotations", "100", "--thread-rotations", "0"]) == 0
+        output = capsys.readouterr().out
+        assert "100 rotations" in output
+        assert "thread growth: not measured" in output